@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+
+"""
+collect_iqtree_results.py
+
+This script collects the results of the IQ-TREE runs in this project into one table, so that the phylogenies
+of the protein families (SMC, kleisin, kite) and of the individual proteins can be compared without opening
+every log file by hand.
+
+Two kinds of IQ-TREE output are parsed:
+1. Screen log files (*.iqtree.log): substitution model, best log-likelihood (BEST SCORE FOUND), log-likelihood
+   of the consensus tree and the CPU and wall-clock time used
+2. Topology test reports (*.test.iqtree.iqtree): substitution model, log-likelihood of the starting tree and the
+   USER TREES table with the results of the KH, SH and AU tests (and bp-RELL, c-ELW) for each tree
+Models are reported in one short form for both kinds of file, so that the test reports can be grouped with the
+logs of the same analyses: mixture models in the reports are reduced to their short name (e.g.
+MIX{LG+FC60pi1,...,LG+FC60pi60}+G4 to LG+C60+G4), and the rate heterogeneity that a model given in the logs implies
+is added to it (e.g. LG+C60, an alias for LG+POISSON+G+FMIX{...}, to LG+C60+G4). The full definition is kept in a
+separate column.
+
+Files are read line by line, and the parsed results are cached (JSON) together with the size and modification
+time of each file; on a next run only new or changed files are parsed again.
+
+Output:
+- Comma-separated table with one row per log file and one row per tree in each topology test report, indexed by
+  the protein (family) directory ('group'), the run (file name) and the tree number (topology tests only)
+- Cache file (JSON) next to the output table, unless specified otherwise
+
+Example usage: collect_iqtree_results.py -d ../protein_families/ ../proteins/ -o iqtree_results.csv
+"""
+
+
+import argparse
+import json
+import os
+import re
+import pandas as pd
+
+
+# test columns of the USER TREES table in the topology test reports; each value is followed by a '+' or '-'
+test_columns_signed = ["bp-RELL", "p-KH", "p-SH", "c-ELW", "p-AU"]
+
+result_columns = ["group", "run", "type", "tree", "model", "model_definition", "best_logL", "consensus_logL", "start_logL", "logL", "deltaL"] + \
+    [col for c in test_columns_signed for col in (c, f"{c}_confidence")] + ["cpu_time", "wallclock_time", "path"]
+
+# cache entries parsed by an older version of this script are parsed again
+cache_version = 3
+
+
+def find_iqtree_files(directories):
+    """Collect the paths of IQ-TREE screen logs and topology test reports in the (sub)directories"""
+    paths = []
+    for directory in directories:
+        for root, dirs, files in os.walk(directory):
+            for f in files:
+                if f.endswith(".iqtree.log") or f.endswith(".test.iqtree.iqtree"):
+                    paths.append(os.path.join(root, f))
+    return sorted(paths)
+
+
+def get_model_from_command(command):
+    """Get the substitution model from the '-m' option of an IQ-TREE command line"""
+    m = re.search(r'\s-m\s+(\S+)', command)
+    return m.group(1) if m else ""
+
+
+def get_short_model(model):
+    """Reduce a mixture model to a short name, e.g. MIX{LG+FC60pi1,...,LG+FC60pi60}+G4 to LG+C60+G4; other models are returned as is"""
+    m = re.fullmatch(r'MIX\{(.*)\}(.*)', model)
+    if m is None:
+        return model
+    components = []
+    for component in m.group(1).split(","):
+        # profile mixture components, e.g. LG+FC60pi1: LG+C60
+        component = re.sub(r'\+F(C\d+)pi\d+$', r'+\1', component)
+        if component not in components:
+            components.append(component)
+    short_model = components[0] if len(components) == 1 else "MIX{" + ",".join(components) + "}"
+    return short_model + m.group(2)
+
+
+def add_implied_rates(model, definition):
+    """Add the rate heterogeneity implied by the definition of a model alias to the model, e.g. LG+C60 (alias for
+    LG+POISSON+G+FMIX{...}) to LG+C60+G4; IQ-TREE uses 4 rate categories unless specified otherwise"""
+    # rate heterogeneity outside the mixture definition, e.g. +G, +G8, +I, +R5
+    rates = re.findall(r'\+(I|G\d*|R\d*)(?=\+|$)', re.sub(r'\{[^}]*\}', '', definition))
+    for rate in rates:
+        rate = rate + "4" if rate in ("G", "R") else rate
+        if not re.search(rf'\+{rate[0]}\d*(?=\+|$)', model):
+            model += f"+{rate}"
+    return model
+
+
+def parse_iqtree_log(path):
+    """Parse an IQ-TREE screen log; for restarted (checkpointed) runs, the last run in the log is kept"""
+    record = {"type": "log", "model": "", "model_definition": "", "best_logL": None, "consensus_logL": None, "cpu_time": None, "wallclock_time": None}
+    # Some logs contain stray non-UTF-8 bytes
+    with open(path, "r", errors="replace") as infile:
+        for line in infile:
+            if line.startswith("Command:"):
+                record["model"] = get_model_from_command(line)
+                record["model_definition"] = record["model"]
+            elif line.startswith("Model ") and " is alias for " in line:
+                # e.g. Model LG+C60 is alias for LG+POISSON+G+FMIX{C60pi1:1:0.0169698865,...}
+                record["model_definition"] = line.split(" is alias for ")[1].strip()
+            elif line.startswith("Best-fit model:"):
+                # ModelFinder was used: overrides the model given on the command line
+                record["model"] = line.split(":")[1].split()[0]
+                record["model_definition"] = record["model"]
+            elif line.startswith("BEST SCORE FOUND"):
+                record["best_logL"] = float(line.split(":")[1])
+            elif line.startswith("Log-likelihood of consensus tree:"):
+                record["consensus_logL"] = float(line.split(":")[1])
+            elif line.startswith("Total CPU time used:"):
+                record["cpu_time"] = float(line.split(":")[1].split()[0])
+            elif line.startswith("Total wall-clock time used:"):
+                record["wallclock_time"] = float(line.split(":")[1].split()[0])
+    record["model"] = add_implied_rates(record["model"], record["model_definition"])
+    return [record]
+
+
+def parse_test_row(line):
+    """Parse a row of the USER TREES table, e.g. '  2 -332893.2758  537.72  0.0022 -  0.003 -  0.003 -    0.0022 -  0.00212 - '"""
+    fields = line.split()
+    row = {"tree": int(fields[0])}
+    row["logL"], row["deltaL"] = float(fields[1]), float(fields[2])
+    for i, col in enumerate(test_columns_signed):
+        row[col] = float(fields[3 + 2*i])
+        row[f"{col}_confidence"] = fields[4 + 2*i]
+    return row
+
+
+def parse_iqtree_test_report(path):
+    """Parse an IQ-TREE report of a topology test; returns one record per tree in the USER TREES table"""
+    model, start_logL, cpu_time, wallclock_time = "", None, None, None
+    rows = []
+    in_table = False
+    with open(path, "r", errors="replace") as infile:
+        for line in infile:
+            if line.startswith("Model of substitution:") or line.startswith("Mixture model of substitution:"):
+                model = line.split(":", 1)[1].strip()
+            elif line.startswith("Log-likelihood of the tree:"):
+                start_logL = float(line.split(":")[1].split()[0])
+            elif line.startswith("Tree") and "p-AU" in line:
+                in_table = True
+            elif in_table:
+                if line.startswith("---"):
+                    continue
+                if line.strip() == "":
+                    in_table = False
+                    continue
+                rows.append(parse_test_row(line))
+            elif line.startswith("Total CPU time used:"):
+                cpu_time = float(line.split(":")[1].split()[0])
+            elif line.startswith("Total wall-clock time used:"):
+                wallclock_time = float(line.split(":")[1].split()[0])
+    records = []
+    for row in rows:
+        record = {"type": "topology_test", "model": get_short_model(model), "model_definition": model, "start_logL": start_logL, "cpu_time": cpu_time, "wallclock_time": wallclock_time}
+        record.update(row)
+        records.append(record)
+    return records
+
+
+def parse_iqtree_file(path):
+    """Parse a log or test report and label the records with the group (directory) and run (file name)"""
+    if path.endswith(".test.iqtree.iqtree"):
+        records = parse_iqtree_test_report(path)
+        run = os.path.basename(path)[:-len(".iqtree.iqtree")]
+    else:
+        records = parse_iqtree_log(path)
+        run = os.path.basename(path)[:-len(".log")]
+    group = os.path.basename(os.path.dirname(os.path.abspath(path)))
+    for record in records:
+        record.update({"group": group, "run": run, "path": path})
+    return records
+
+
+def load_cache(cache_path):
+    if os.path.exists(cache_path):
+        with open(cache_path, "r") as infile:
+            return json.load(infile)
+    return {}
+
+
+def collect_iqtree_results(paths, cache):
+    """Get the records of all files, parsing only those files that are not (or no longer) up to date in the cache"""
+    updated_cache = {}
+    records = []
+    n_parsed = 0
+    for path in paths:
+        stat = os.stat(path)
+        entry = cache.get(path)
+        if entry is None or entry.get("version") != cache_version or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime:
+            entry = {"version": cache_version, "size": stat.st_size, "mtime": stat.st_mtime, "records": parse_iqtree_file(path)}
+            n_parsed += 1
+        updated_cache[path] = entry
+        records.extend(entry["records"])
+    print(f"Parsed {n_parsed} of {len(paths)} IQ-TREE files; {len(paths) - n_parsed} taken from cache")
+    return records, updated_cache
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Collect models, log-likelihoods, run times and topology test results from IQ-TREE logs and reports")
+    parser.add_argument("-d", metavar="directories", nargs="+", type=str, default=["../protein_families/", "../proteins/"], help="directories searched (recursively) for *.iqtree.log and *.test.iqtree.iqtree files")
+    parser.add_argument("-o", metavar="output", type=str, default="iqtree_results.csv", help="name of output csv table")
+    parser.add_argument("-c", metavar="cache", type=str, help="path to the cache file - output name with suffix '.cache.json' if not specified")
+    args = parser.parse_args()
+
+    cache_path = args.c if args.c != None else f"{args.o}.cache.json"
+
+    iqtree_files = find_iqtree_files(args.d)
+    records, cache = collect_iqtree_results(iqtree_files, load_cache(cache_path))
+
+    with open(cache_path, "w") as outfile:
+        json.dump(cache, outfile)
+
+    results = pd.DataFrame(records, columns=result_columns)
+    # log files have no tree number; keep the tree numbers integers
+    results["tree"] = results["tree"].astype("Int64")
+    results = results.sort_values(["group", "run", "tree"], na_position="first").set_index(["group", "run", "tree"])
+    results.to_csv(args.o, index=True)
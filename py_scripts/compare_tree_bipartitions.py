@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+
+"""
+compare_tree_bipartitions.py
+
+This script compares the topologies of phylogenies without external tools, e.g. the maximum-likelihood tree
+(.treefile), the ultrafast bootstrap consensus tree (.contree) and the constraint tree (.constr1*.treefile) of a
+protein family, or the annotated trees (.annotated.nexus) of the proteins.
+
+Each tree is encoded as a set of splits (bipartitions): a split is a bitset (a Python integer, stored as bytes)
+whose bits mark the leaves on one side, using one leaf index shared by all trees. Comparing two trees is then reduced to set
+operations on these integers, which keeps the comparison fast for trees with tens of thousands of leaves.
+Trees are treated as unrooted; if two trees do not contain the same leaves, the splits are restricted to the
+leaves they share.
+
+For each pair of trees, the script reports:
+1. The Robinson-Foulds (RF) distance: the number of splits found in only one of both trees
+2. The normalized RF distance: RF divided by the total number of splits of both trees (works for the
+   multifurcating constraint trees as well)
+3. The number of splits each tree lacks compared to the other, and the mean support (e.g. ultrafast bootstrap)
+   of these splits in the tree that does contain them
+
+Required input:
+- Directory containing tree files (.treefile, .contree or FigTree-style .nexus) and/or a list of tree files
+
+Output:
+- Comma-separated table with the pairwise comparisons
+- Optional: comma-separated table listing each split of each tree, its support and its support in the other
+  tree of the pair (empty if the other tree lacks it)
+
+Example usage: compare_tree_bipartitions.py -d ../protein_families/Kite/ -o Kite.tree_comparison.csv -s Kite.tree_comparison.splits.csv
+"""
+
+
+import argparse
+import itertools
+import multiprocessing
+import os
+import re
+import pandas as pd
+
+
+tree_suffixes = (".treefile", ".contree", ".nexus")
+
+comparison_columns = ["tree1", "tree2", "common_leaves", "splits_tree1", "splits_tree2", "rf", "nrf", "missing_in_tree1",
+                      "missing_in_tree2", "mean_support_missing_in_tree1", "mean_support_missing_in_tree2"]
+
+split_columns = ["tree", "other_tree", "split_size", "support", "support_other_tree", "in_other_tree", "leaves"]
+
+# quoted labels, comments, punctuation and unquoted labels/branch lengths
+newick_tokens = re.compile(r"'(?:[^']|'')*'|\[[^\]]*\]|[(),:;]|[^(),:;\[\]'\s]+")
+
+
+def read_tree_string(path):
+    """Read the (first) tree of a newick file or of the trees block of a NEXUS file as a newick string"""
+    with open(path, "r") as infile:
+        text = infile.read()
+    if text.lstrip().upper().startswith("#NEXUS"):
+        m = re.search(r'^\s*tree\s+[^=]+=\s*(?:\[&[RU]\]\s*)?(.*;)', text, re.IGNORECASE | re.MULTILINE)
+        if m is None:
+            raise ValueError(f"No tree found in NEXUS file {path}")
+        return m.group(1)
+    return text.strip()
+
+
+def simplify_leaf_name(name):
+    """Remove quotes and the sequence range (e.g. 'ACACAS001419/6-623') from a leaf name"""
+    if name.startswith("'"):
+        name = name[1:-1].replace("''", "'")
+    return name.split("/")[0]
+
+
+def get_support(label):
+    """Get the support value from an internal node label; for 'SH-aLRT/UFBoot' labels the last value is used"""
+    try:
+        return float(label.split("/")[-1])
+    except ValueError:
+        return None
+
+
+def parse_newick(newick):
+    """Parse a newick string into its leaf names and its clades in postorder
+
+    Each clade is a tuple (children, support); a child is a leaf position (>= 0) or, for a clade, the bitwise
+    inverse of its position in the clade list (< 0). The last clade is the root.
+    """
+    leaf_names, clades = [], []
+    stack = []
+    closed = None  # clade closed by the last ')'; labels and comments that follow it belong to this clade
+    expect_length = False
+    for token in newick_tokens.findall(newick):
+        if expect_length:
+            expect_length = False
+            continue
+        if token == "(":
+            stack.append([])
+            closed = None
+        elif token == ")":
+            clades.append([stack.pop(), None])
+            closed = len(clades) - 1
+            if stack:
+                stack[-1].append(~closed)
+        elif token == ",":
+            closed = None
+        elif token == ":":
+            expect_length = True
+        elif token == ";":
+            break
+        elif token.startswith("["):
+            # FigTree annotations, e.g. [&label=100] or [&label=89,!name="Nse1"]
+            m = re.search(r'label=([^,\]]+)', token)
+            if closed is not None and m:
+                clades[closed][1] = get_support(m.group(1).strip('"'))
+        elif closed is not None:
+            clades[closed][1] = get_support(token)
+        else:
+            stack[-1].append(len(leaf_names))
+            leaf_names.append(simplify_leaf_name(token))
+    return leaf_names, [tuple(c) for c in clades]
+
+
+def encode_splits(leaf_names, clades, leaf_index):
+    """Encode the clades as bitsets over the shared leaf index; returns the leaf mask and the splits with their support"""
+    leaf_bits = [1 << leaf_index[name] for name in leaf_names]
+    clade_bits = []
+    for children, support in clades:
+        bits = 0
+        for child in children:
+            bits |= leaf_bits[child] if child >= 0 else clade_bits[~child]
+        clade_bits.append(bits)
+    mask = clade_bits[-1]
+    supports = [support for children, support in clades]
+    return mask, collect_splits(zip(clade_bits, supports), mask)
+
+
+def split_key(split):
+    """Bitsets are stored as bytes: Python hashes large integers poorly (by their value modulo 2**61 - 1), which
+    makes the sets of splits of e.g. ladder-like trees collide, whereas the hash of bytes is well spread"""
+    return split.to_bytes((split.bit_length() + 7) // 8, "little")
+
+
+def split_bits(key):
+    return int.from_bytes(key, "little")
+
+
+def collect_splits(splits, mask):
+    """Collect the informative splits within the mask, each represented by the side without the first leaf of the
+    mask (unrooted trees); trivial splits (a single leaf versus the rest) are shared by all trees and are skipped"""
+    first_leaf = mask & -mask
+    n_leaves = mask.bit_count()
+    collected = {}
+    for bits, support in splits:
+        bits &= mask
+        split = mask ^ bits if bits & first_leaf else bits
+        size = split.bit_count()
+        if size > 1 and n_leaves - size > 1:
+            key = split_key(split)
+            if collected.get(key) is None:
+                collected[key] = support
+    return collected
+
+
+def restrict_splits(splits, mask):
+    """Restrict splits to the leaves in the mask, e.g. the leaves shared with another tree"""
+    return collect_splits(((split_bits(key), support) for key, support in splits.items()), mask)
+
+
+def map_support(splits, reference_splits):
+    """Get the support in the reference tree of each split; None if the reference tree lacks the split"""
+    return {split: reference_splits.get(split) for split in splits}
+
+
+def mean_support(splits, missing):
+    values = [splits[s] for s in missing if splits[s] is not None]
+    return sum(values) / len(values) if values else None
+
+
+def compare_splits(name1, mask1, splits1, name2, mask2, splits2):
+    """Compare the splits of two trees on their shared leaves"""
+    common_mask = mask1 & mask2
+    if common_mask != mask1:
+        splits1 = restrict_splits(splits1, common_mask)
+    if common_mask != mask2:
+        splits2 = restrict_splits(splits2, common_mask)
+    missing_in_2 = splits1.keys() - splits2.keys()
+    missing_in_1 = splits2.keys() - splits1.keys()
+    rf = len(missing_in_1) + len(missing_in_2)
+    max_rf = len(splits1) + len(splits2)
+    comparison = {
+        "tree1": name1,
+        "tree2": name2,
+        "common_leaves": common_mask.bit_count(),
+        "splits_tree1": len(splits1),
+        "splits_tree2": len(splits2),
+        "rf": rf,
+        "nrf": rf / max_rf if max_rf > 0 else 0.0,
+        "missing_in_tree1": len(missing_in_1),
+        "missing_in_tree2": len(missing_in_2),
+        "mean_support_missing_in_tree1": mean_support(splits2, missing_in_1),
+        "mean_support_missing_in_tree2": mean_support(splits1, missing_in_2)
+    }
+    return comparison, splits1, splits2
+
+
+def list_splits(name, splits, other_name, other_splits, leaf_names):
+    """List the splits of a tree with their support in this and in the other tree; a split is named by the leaves on its canonical side"""
+    rows = []
+    other_support = map_support(splits, other_splits)
+    for key, support in splits.items():
+        split = split_bits(key)
+        rows.append({
+            "tree": name,
+            "other_tree": other_name,
+            "split_size": split.bit_count(),
+            "support": support,
+            "support_other_tree": other_support[key],
+            "in_other_tree": key in other_splits,
+            "leaves": ";".join(leaf_names[i] for i in range(split.bit_length()) if split >> i & 1)
+        })
+    return rows
+
+
+# Trees are shared with the worker processes through the initializer, instead of being sent along with each pair
+_trees = {}
+
+
+def _init_worker(trees):
+    global _trees
+    _trees = trees
+
+
+def _compare_pair(pair):
+    name1, name2 = pair
+    mask1, splits1 = _trees[name1]
+    mask2, splits2 = _trees[name2]
+    return compare_splits(name1, mask1, splits1, name2, mask2, splits2)
+
+
+def get_tree_paths(directory, files):
+    """Collect the tree files; files given more than once (e.g. through both -d and -f) are used once"""
+    paths = list(files) if files else []
+    if directory:
+        paths += [os.path.join(directory, f) for f in sorted(os.listdir(directory)) if f.endswith(tree_suffixes)]
+    unique_paths = []
+    seen = set()
+    for path in paths:
+        real_path = os.path.realpath(path)
+        if real_path in seen:
+            print(f"{path} is given more than once; used once")
+            continue
+        seen.add(real_path)
+        unique_paths.append(path)
+    return unique_paths
+
+
+def get_tree_names(paths):
+    """Name the trees by their path relative to the common directory of all trees, so that trees with the same file
+    name in different directories (e.g. proteins/Rec8/ and proteins/Scc1/) are kept apart"""
+    abs_paths = [os.path.abspath(path) for path in paths]
+    common_dir = os.path.commonpath([os.path.dirname(path) for path in abs_paths])
+    return [os.path.relpath(path, common_dir) for path in abs_paths]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare tree topologies (Robinson-Foulds distances, missing splits and their support) all-vs-all")
+    parser.add_argument("-d", metavar="tree_directory", type=str, help="directory with tree files (.treefile, .contree, .nexus)")
+    parser.add_argument("-f", metavar="tree_files", nargs="+", type=str, help="tree files (newick or FigTree NEXUS)")
+    parser.add_argument("-o", metavar="output", type=str, default="tree_comparison.csv", help="name of output csv table")
+    parser.add_argument("-s", metavar="split_output", type=str, help="name of output csv table listing all splits of each pair of trees (optional)")
+    parser.add_argument("-n", metavar="threads", type=int, default=1, help="number of processes used for the comparisons")
+    args = parser.parse_args()
+
+    tree_paths = get_tree_paths(args.d, args.f)
+    if len(tree_paths) < 2:
+        parser.error("at least two trees are required")
+
+    # Parse the trees and build the leaf index shared by all trees
+    parsed_trees = {}
+    for name, path in zip(get_tree_names(tree_paths), tree_paths):
+        parsed_trees[name] = parse_newick(read_tree_string(path))
+    all_leaf_names = sorted(set(name for leaf_names, clades in parsed_trees.values() for name in leaf_names))
+    leaf_index = {name: i for i, name in enumerate(all_leaf_names)}
+
+    trees = {}
+    for name, (leaf_names, clades) in parsed_trees.items():
+        if len(set(leaf_names)) < len(leaf_names):
+            print(f"Error: {name} contains duplicate leaf names (after removing the sequence ranges)")
+        trees[name] = encode_splits(leaf_names, clades, leaf_index)
+    del parsed_trees
+
+    pairs = list(itertools.combinations(trees.keys(), 2))
+    if args.n > 1:
+        with multiprocessing.Pool(args.n, initializer=_init_worker, initargs=(trees,)) as pool:
+            results = pool.map(_compare_pair, pairs, chunksize=max(1, len(pairs) // (4 * args.n)))
+    else:
+        _init_worker(trees)
+        results = [_compare_pair(pair) for pair in pairs]
+
+    # Trees without informative splits in common, e.g. from different protein families, are not reported
+    results = [result for result in results if result[0]["common_leaves"] > 3]
+    if len(results) == 0:
+        print("No pair of trees shares more than 3 leaves; no trees were compared")
+    comparisons = pd.DataFrame([comparison for comparison, splits1, splits2 in results], columns=comparison_columns)
+    comparisons.to_csv(args.o, index=False)
+
+    if args.s != None:
+        split_rows = []
+        for comparison, splits1, splits2 in results:
+            split_rows += list_splits(comparison["tree1"], splits1, comparison["tree2"], splits2, all_leaf_names)
+            split_rows += list_splits(comparison["tree2"], splits2, comparison["tree1"], splits1, all_leaf_names)
+        pd.DataFrame(split_rows, columns=split_columns).to_csv(args.s, index=False)
@@ -26,6 +26,11 @@ Required input:
 Output:
 - Reformatted tree file
 - Multiple iTOL annotation datasets for visualization
+- Cache of the labelled tree (topology and node labels); when the script is run again with the same tree, metadata,
+  root leaves and clade files, the labelled tree is loaded from the cache instead of being relabelled
+- Optional: the labelled tree in NHX format and/or as annotated NEXUS (FigTree). In the NHX export, ete3 replaces
+  the characters that NHX does not allow in values (e.g. the ';' separating the ranks of the taxonomy) by '_'; the
+  annotated NEXUS export keeps the labels as they are
 
 Example usage: generate_input_data_iTol_SMC_PreLECA.py -t ../protein_families/Kite/euk5_homs6.Nse1_Nse3.ginsi_dash.cut.gappyout.drop.iqtree.treefile -r Arch_Asgardarchaeota_Heimdallarchaeia_GB_GCA_001940645.1_MDVS01000047.1_5 Arch_Altiarchaeota_Altiarchaeia_GB_GCA_016935655.1_JAFGQM010000011.1_41 -p clade.Nse1.txt clade.Nse3.txt clade.Kite_unknown_archaea.txt clade.Nse1_Nse3_related.txt  clade.Nse3_related.txt
 The clade files contains identifiers of proteins belonging to a particular subfamilies, or clade, in the phylogeny, either prokaryotic or eukaryotic. For instance, clade.Nse1.txt contains a list with the identifiers of the eukaryotic Nse1 proteins: 
@@ -40,6 +45,9 @@ from ete3 import Tree
 import argparse
 import pandas as pd
 import os
+import gzip
+import hashlib
+import json
 from functions import checktrailingslash, make_list_from_lines, find_largest_common_prefix
 import re
 import collections
@@ -88,6 +96,13 @@ colors_complex_members = {
     "Nse3": "#aa3377"
 }
 
+# node labels assigned by label_leaves and label_internal_nodes, stored in the labelled tree cache
+node_features = ["protein", "domain", "clade", "rank", "accession", "species", "phylum", "clas", "taxonomy", "rel_clade"]
+
+# part of the cache key: increase whenever the labelling (label_leaves, label_internal_nodes) or the stored data change
+labelled_tree_cache_version = 2
+
+
 def simplify_leaf_names(tree):
     for leaf in tree:
         leaf.name = leaf.name.split("/")[0]
@@ -283,16 +298,17 @@ def get_color_list(num_colors):
     return hex_list
 
 
-def generate_itol_dataset_paralogs(tree, arch_metadata, bact_metadata):
+def generate_itol_dataset_paralogs(tree):
     """Add coloured symbols to paralog leaves"""
     dataset = []
     paralog_taxa = []
     # First get the taxa that have paralogs in the tree
     for l in tree.get_leaves():
-        if l.domain == "Archaea" and l.accession in arch_metadata.index:
+        # Leaves have a taxonomy only if their accession is found in the metadata
+        if l.domain == "Archaea" and hasattr(l, "taxonomy"):
             if len(tree.search_nodes(domain="Archaea", accession = l.accession)) > 1 and l.name not in paralog_taxa:
                 paralog_taxa.append(l.accession)
-        elif l.domain == "Bacteria" and l.accession in bact_metadata.index:
+        elif l.domain == "Bacteria" and hasattr(l, "taxonomy"):
             if len(tree.search_nodes(domain="Bacteria", accession = l.accession)) > 1 and l.name not in paralog_taxa:
                 paralog_taxa.append(l.accession)
     paralog_taxa = list(set(paralog_taxa))
@@ -323,6 +339,103 @@ def generate_itol_dataset_membership(tree):
     return dataset
 
 
+def get_cache_key(tree_path, metadata_paths, root_leaves, protein_membership_paths):
+    """Hash of all input that determines the labelled tree: the tree, the metadata tables, the root leaves and the clade
+    files, and the version of the labelling"""
+    h = hashlib.sha256()
+    h.update(f"labelled_tree_cache_version={labelled_tree_cache_version}\0".encode())
+    for path in [tree_path] + metadata_paths + (protein_membership_paths or []):
+        h.update(path.encode() + b"\0")
+        with open(path, "rb") as f:
+            h.update(f.read())
+        h.update(b"\0")
+    h.update("\n".join(root_leaves or []).encode())
+    return h.hexdigest()
+
+
+def write_labelled_tree_cache(tree, cache_path, cache_key):
+    """Store the labelled tree: the topology (newick) and, per label, an array with the values of all nodes in preorder;
+    branch lengths and support values are stored as arrays as well, as the newick rounds them to 6 digits"""
+    nodes = list(tree.traverse("preorder"))
+    cache = {
+        "key": cache_key,
+        "newick": tree.write(format=0),
+        "dist": [n.dist for n in nodes],
+        "support": [n.support for n in nodes],
+        "features": {feature: [getattr(n, feature, None) for n in nodes] for feature in node_features}
+    }
+    with gzip.open(cache_path, "wt") as f:
+        json.dump(cache, f)
+
+
+def load_labelled_tree_cache(cache_path, cache_key):
+    """Load the labelled tree from the cache; returns None if there is no cache or if it was made from different input"""
+    if not os.path.exists(cache_path):
+        return None
+    with gzip.open(cache_path, "rt") as f:
+        cache = json.load(f)
+    if cache["key"] != cache_key:
+        return None
+    tree = Tree(cache["newick"], format=0)
+    nodes = list(tree.traverse("preorder"))
+    for n, dist, support in zip(nodes, cache["dist"], cache["support"]):
+        n.dist = dist
+        n.support = support
+    for feature, values in cache["features"].items():
+        for n, value in zip(nodes, values):
+            # Labels that were not assigned (e.g. the taxonomy of leaves missing from the metadata) remain unassigned
+            if value is not None:
+                setattr(n, feature, value)
+    return tree
+
+
+def quote_nexus_label(name):
+    """Quote a taxon label as in the annotated NEXUS files of the proteins, e.g. 'ACACAS001419/6-623'"""
+    return "'" + name.replace("'", "''") + "'"
+
+
+def get_figtree_annotation(node):
+    """FigTree annotation of a node: the support (internal nodes except the root) as label, and the node labels as quoted strings"""
+    annotations = []
+    if not node.is_leaf() and not node.is_root():
+        annotations.append(f"label={node.support:g}")
+    for feature in node_features:
+        value = getattr(node, feature, None)
+        if value != None:
+            # double quotes in values would end the quoted string
+            value = str(value).replace('"', "'")
+            annotations.append(f'{feature}="{value}"')
+    return f"[&{','.join(annotations)}]" if annotations else ""
+
+
+def write_annotated_nexus(tree, path):
+    """Write the labelled tree as annotated NEXUS, with the node labels as FigTree annotations"""
+    # The newick string is built in postorder (not recursively), as the trees can be deeper than the recursion limit
+    # e.g. ('SMC1':0.5,'SMC1':0.2)[&label=100,protein="SMC1",domain="Eukaryota"]:0.1
+    subtrees = {}
+    for node in tree.traverse("postorder"):
+        if node.is_leaf():
+            subtree = quote_nexus_label(node.name)
+        else:
+            subtree = "(" + ",".join(subtrees.pop(child) for child in node.children) + ")"
+        subtree += get_figtree_annotation(node)
+        if not node.is_root():
+            subtree += f":{node.dist}"
+        subtrees[node] = subtree
+    leaf_names = tree.get_leaf_names()
+    with open(path, "w") as file:
+        file.write("#NEXUS\n")
+        file.write("begin taxa;\n")
+        file.write(f"\tdimensions ntax={len(leaf_names)};\n")
+        file.write("\ttaxlabels\n")
+        for name in leaf_names:
+            file.write(f"\t{quote_nexus_label(name)}\n")
+        file.write(";\nend;\n\n")
+        file.write("begin trees;\n")
+        file.write(f"\ttree tree_1 = [&R] {subtrees[tree]};\n")
+        file.write("end;\n")
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Generate iTol datasets to annotate a gene phylogeny')
     parser.add_argument('-t', metavar='tree_path', type=str, help='Path to the input newick tree file')
@@ -332,6 +445,8 @@ if __name__ == "__main__":
     parser.add_argument('-o', metavar='output_dir', type=str, help='output directory - current working directory if not specified')
     parser.add_argument('-r', metavar='root_leaves', nargs='+', type=str, help='List of leaf names for rooting the tree')
     parser.add_argument('-p', metavar='protein_membership', nargs='+', type=str, help='List of text files containing subfamily memberships of (prokaryotic) sequences - suffix should be ".txt"')
+    parser.add_argument('-c', metavar='cache_dir', type=str, help='directory for the labelled tree cache - output directory if not specified')
+    parser.add_argument('-x', metavar='export', nargs='+', type=str, choices=['nhx', 'nexus'], help='export the labelled tree in NHX and/or annotated NEXUS format - NHX values are sanitised by ete3 (e.g. ";" becomes "_"), use NEXUS for unaltered labels')
     args = parser.parse_args()
 
     # Get the output directory
@@ -343,34 +458,62 @@ if __name__ == "__main__":
     # Get the basename of the input tree
     tree_basename = os.path.basename(args.t)
     
-    # Load the tree from file
-    tree = Tree(args.t)
+    # Get the directory of the labelled tree cache
+    if args.c == None:
+        cachedir = outdir
+    else:
+        cachedir = checktrailingslash(args.c)
+    os.makedirs(cachedir, exist_ok=True)
+    cache_path = f"{cachedir}{tree_basename}.labelled_tree_cache.json.gz"
+    cache_key = get_cache_key(args.t, [args.ma, args.mb, args.me], args.r, args.p)
 
-    # Simplify leaf names
-    simplify_leaf_names(tree)
+    # Load the labelled tree from the cache if it was made from the same input
+    tree = load_labelled_tree_cache(cache_path, cache_key)
 
-    # Reroot the tree
-    reroot_tree(tree, args.r)
+    if tree != None:
+        print(f"Labelled tree loaded from cache: {cache_path}")
+        # Write new tree to newick
+        tree.write(outfile=f"{outdir}{tree_basename}.reformatted", format=0)
 
-    # Remove sequences from AlphaFold structures from the tree
-    clean_tree(tree)
+    else:
+        # Load the tree from file
+        tree = Tree(args.t)
 
-    # Write new tree to newick
-    tree.write(outfile=f"{outdir}{tree_basename}.reformatted", format=0)
-    
-    # Load species metadata
-    archaea_metadata = pd.read_csv(args.ma, index_col="accession")
-    bacteria_metadata = pd.read_csv(args.mb, index_col="accession")
-    eukaryota_metadata = pd.read_csv(args.me, index_col="Abbreviation")
-    
-    # Load protein memberships (for prokaryotes)
-    protein_memberships_from_txt = get_protein_memberships_from_txtfiles(args.p)
-    
-    # Label the leaves according to their domain and lower taxonomy or protein
-    label_leaves(tree, archaea_metadata, bacteria_metadata, eukaryota_metadata, protein_memberships_from_txt)
+        # Simplify leaf names
+        simplify_leaf_names(tree)
+
+        # Reroot the tree
+        reroot_tree(tree, args.r)
+
+        # Remove sequences from AlphaFold structures from the tree
+        clean_tree(tree)
+
+        # Write new tree to newick
+        tree.write(outfile=f"{outdir}{tree_basename}.reformatted", format=0)
+        
+        # Load species metadata
+        archaea_metadata = pd.read_csv(args.ma, index_col="accession")
+        bacteria_metadata = pd.read_csv(args.mb, index_col="accession")
+        eukaryota_metadata = pd.read_csv(args.me, index_col="Abbreviation")
+        
+        # Load protein memberships (for prokaryotes)
+        protein_memberships_from_txt = get_protein_memberships_from_txtfiles(args.p)
+        
+        # Label the leaves according to their domain and lower taxonomy or protein
+        label_leaves(tree, archaea_metadata, bacteria_metadata, eukaryota_metadata, protein_memberships_from_txt)
+
+        # Label the internal nodes: protein name and taxonomy (the latter for prokaryotes only)
+        label_internal_nodes(tree)
+
+        # Store the labelled tree, so that the datasets can be regenerated without relabelling
+        write_labelled_tree_cache(tree, cache_path, cache_key)
 
-    # Label the internal nodes: protein name and taxonomy (the latter for prokaryotes only)
-    label_internal_nodes(tree)
+    # Export the labelled tree
+    if args.x != None:
+        if 'nhx' in args.x:
+            tree.write(outfile=f"{outdir}{tree_basename}.reformatted.labelled.nhx", format=0, features=node_features)
+        if 'nexus' in args.x:
+            write_annotated_nexus(tree, f"{outdir}{tree_basename}.reformatted.labelled.annotated.nexus")
 
     # Generate and write the iTol dataset to branch colours according to the species domain (Eukaryota, Archaea, Bacteria)
     dataset_branch_colours = generate_itol_dataset_branch_colours(tree)
@@ -401,7 +544,7 @@ if __name__ == "__main__":
             file.write(f"{item}\n")
     
     # Generate and write the iTol dataset for paralogs 
-    dataset_paralogs = generate_itol_dataset_paralogs(tree, archaea_metadata, bacteria_metadata)
+    dataset_paralogs = generate_itol_dataset_paralogs(tree)
     with open(f"{outdir}{tree_basename}.reformatted.iTOL_paralogshapes.dataset.txt", "w") as file:
         file.write("DATASET_SYMBOL\n")
         file.write("SEPARATOR COMMA\n")
@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+
+"""
+infer_orthogroups_species_overlap.py
+
+This script proposes orthogroups from the gene trees of the proteins (euk5_homs* phylogenies in the protein
+directories), to be compared with the orthogroups that were set out by hand (euk5_orths*.txt).
+
+The species of each leaf is taken from its identifier (e.g. HOMSAP049857: HOMSAP). In one postorder pass over
+the tree, the set of species under each node is stored as a bitset (a Python integer with one bit per species).
+Each internal node is then labelled as a duplication or a speciation by the species-overlap score: the number
+of species found under more than one of its children, divided by the number of species under the node. A node
+is a duplication if its score exceeds the threshold (default 0: any overlap). Rooted trees (e.g. the FigTree-rooted
+.annotated.nexus trees) are used as rooted in the tree file. Unrooted trees, i.e. trees with a multifurcating root
+as written by IQ-TREE, are rooted on the branch that minimises the number of duplications; the number of
+duplications for every possible root is computed in one postorder and one preorder pass.
+
+Candidate orthogroups are the clades emanating from duplication nodes, and the whole tree. Each candidate is
+scored against the most recent orthogroup list of the protein (euk5_orths*.txt, as in collect_pp_euk5_from_text.py)
+by its precision, recall and Jaccard index; the best-scoring candidate is written as a list of identifiers. Each
+candidate is identified by the first and the last leaf of the clade (as in iTOL, the clade spanned by both leaves),
+and by the postorder index and support of the clade and of the duplication node it emanates from (in the tree as
+rooted by this script).
+
+Required input:
+- Directory containing all protein folders, each with a gene tree (.treefile or FigTree-style .nexus) and an
+  orthogroup list (euk5_orths*.txt)
+
+Output:
+- Comma-separated table with all candidate orthogroups of all trees and their scores
+- For each tree, a list (.txt) of the identifiers in the best-scoring candidate, e.g. euk5_candorths.SMC1.txt; if a
+  protein folder contains more than one tree, the protein name is taken from the tree, e.g.
+  euk5_candorths.Separase_tpr.txt
+
+Example usage: infer_orthogroups_species_overlap.py -d ../proteins/ -o candidate_orthogroups/ -n 8
+"""
+
+
+import argparse
+import multiprocessing
+import os
+import re
+import pandas as pd
+from compare_tree_bipartitions import read_tree_string, parse_newick
+
+
+tree_suffixes = (".treefile", ".nexus")
+
+candidate_columns = ["protein", "tree", "rooting", "first_leaf", "last_leaf", "clade", "support", "parent_duplication", "parent_support",
+                     "species", "duplication", "members", "curated", "shared", "precision", "recall", "jaccard"]
+
+identifier_pattern = re.compile(r'^((\D{6})\d{6})')
+
+
+def get_leaf_identifiers(leaf_names):
+    """Get the sequence identifier and species of each leaf (None for leaves without a eukarya.v5 identifier, e.g. prokaryotes)"""
+    identifiers = []
+    for name in leaf_names:
+        m = identifier_pattern.search(name)
+        identifiers.append((m.group(1), m.group(2)) if m else (None, None))
+    return identifiers
+
+
+def is_duplication(child_species, overlap_threshold):
+    """A node is a duplication if its species-overlap score (species under more than one child / species under the
+    node) exceeds the threshold; returns the species bitset of the node as well"""
+    species = 0
+    overlap = 0
+    for s in child_species:
+        overlap |= species & s
+        species |= s
+    score = overlap.bit_count() / species.bit_count() if species else 0.0
+    return score > overlap_threshold, species
+
+
+def label_duplications(leaf_species_bits, clades, overlap_threshold):
+    """Compute the species bitset and the species-overlap score of each clade in one postorder pass; returns the
+    species bitsets and whether each clade is a duplication"""
+    clade_species = []
+    duplications = []
+    for children, support in clades:
+        duplication, species = is_duplication([leaf_species_bits[child] if child >= 0 else clade_species[~child] for child in children], overlap_threshold)
+        clade_species.append(species)
+        duplications.append(duplication)
+    return clade_species, duplications
+
+
+def is_rooted(clades):
+    """IQ-TREE writes unrooted trees with a multifurcating root"""
+    return len(clades[-1][0]) <= 2
+
+
+def root_minimising_duplications(leaf_species_bits, clades, overlap_threshold):
+    """Root an unrooted tree on the branch that minimises the number of duplications; returns the clades of the rooted tree
+
+    Nodes are referred to as in the clades (leaf position, or the bitwise inverse of the clade position). For the
+    branch above each node x, the species and the number of duplications are computed on both sides: below x
+    (postorder) and on the other side, as if the tree were rooted on that branch (preorder).
+    """
+    root = ~(len(clades) - 1)
+    children = {~k: list(c) for k, (c, support) in enumerate(clades)}
+    support = {~k: s for k, (c, s) in enumerate(clades)}  # support of the branch above each clade (none for leaves)
+    parent = {child: node for node, node_children in children.items() for child in node_children}
+    clade_species, duplications = label_duplications(leaf_species_bits, clades, overlap_threshold)
+
+    species_down = {leaf: bits for leaf, bits in enumerate(leaf_species_bits)}
+    duplications_down = {leaf: 0 for leaf in range(len(leaf_species_bits))}
+    for k in range(len(clades)):
+        species_down[~k] = clade_species[k]
+        duplications_down[~k] = duplications[k] + sum(duplications_down[child] for child in children[~k])
+
+    species_up, duplications_up = {}, {}
+    for k in reversed(range(len(clades))):
+        node = ~k
+        for child in children[node]:
+            others = [other for other in children[node] if other != child]
+            other_species = [species_down[other] for other in others] + ([species_up[node]] if node != root else [])
+            duplication, species_up[child] = is_duplication(other_species, overlap_threshold)
+            duplications_up[child] = duplication + sum(duplications_down[other] for other in others) + \
+                (duplications_up[node] if node != root else 0)
+
+    def count_duplications(x):
+        return duplications_down[x] + duplications_up[x] + is_duplication([species_down[x], species_up[x]], overlap_threshold)[0]
+    best = min(parent, key=count_duplications)
+
+    def neighbours(node):
+        return children.get(node, []) + ([parent[node]] if node in parent else [])
+
+    def branch_support(node, other):
+        return support.get(node) if parent.get(node) == other else support.get(other)
+
+    # Write the clades of both sides of the new root in postorder
+    rooted_clades = []
+    new_ref = {}
+    for top, came_from in [(best, parent[best]), (parent[best], best)]:
+        stack = [(top, came_from, False)]
+        while stack:
+            node, came_from_node, expanded = stack.pop()
+            if node >= 0:
+                continue
+            node_children = [other for other in neighbours(node) if other != came_from_node]
+            if not expanded:
+                stack.append((node, came_from_node, True))
+                stack.extend((child, node, False) for child in reversed(node_children))
+            else:
+                rooted_clades.append(([child if child >= 0 else new_ref[child] for child in node_children], branch_support(node, came_from_node)))
+                new_ref[node] = ~(len(rooted_clades) - 1)
+    rooted_clades.append(([node if node >= 0 else new_ref[node] for node in (best, parent[best])], None))
+    return rooted_clades
+
+
+def get_clade_leaves(clades, clade):
+    """Get the leaf positions of a clade"""
+    leaves = []
+    stack = [~clade]
+    while stack:
+        node = stack.pop()
+        if node >= 0:
+            leaves.append(node)
+        else:
+            stack.extend(reversed(clades[~node][0]))
+    return leaves
+
+
+def get_candidate_orthogroups(clades, duplications):
+    """The whole tree and each clade emanating from a duplication node are candidate orthogroups; returns the
+    candidates with their parent duplication node (None for the whole tree)"""
+    root = len(clades) - 1
+    candidates = [(root, None)]
+    for clade, (children, support) in enumerate(clades):
+        if duplications[clade]:
+            candidates += [(~child, clade) for child in children if child < 0]
+    return candidates
+
+
+def score_candidate(members, curated):
+    shared = len(members & curated)
+    return {
+        "members": len(members),
+        "curated": len(curated),
+        "shared": shared,
+        "precision": shared / len(members) if members else 0.0,
+        "recall": shared / len(curated) if curated else 0.0,
+        "jaccard": shared / len(members | curated) if members or curated else 0.0
+    }
+
+
+def infer_orthogroups(protein, tree_path, curated_path, overlap_threshold):
+    """Score all candidate orthogroups of a gene tree; returns the scores and the members of the best candidate"""
+    leaf_names, clades = parse_newick(read_tree_string(tree_path))
+    leaf_identifiers = get_leaf_identifiers(leaf_names)
+    species_index = {}
+    leaf_species_bits = []
+    for identifier, species in leaf_identifiers:
+        leaf_species_bits.append(1 << species_index.setdefault(species, len(species_index)) if species else 0)
+    rooting = "tree file"
+    if not is_rooted(clades):
+        clades = root_minimising_duplications(leaf_species_bits, clades, overlap_threshold)
+        rooting = "minimal duplications"
+        print(f"{protein}: unrooted tree (multifurcating root), rooted on the branch that minimises the number of duplications")
+    clade_species, duplications = label_duplications(leaf_species_bits, clades, overlap_threshold)
+
+    with open(curated_path, "r") as infile:
+        curated = set(line.strip() for line in infile if line.strip())
+
+    rows = []
+    best_members, best_jaccard = [], -1.0
+    for clade, parent in get_candidate_orthogroups(clades, duplications):
+        leaves = get_clade_leaves(clades, clade)
+        members = [leaf_identifiers[leaf][0] for leaf in leaves if leaf_identifiers[leaf][0] != None]
+        row = {
+            "protein": protein,
+            "tree": os.path.basename(tree_path),
+            "rooting": rooting,
+            "first_leaf": leaf_names[leaves[0]],
+            "last_leaf": leaf_names[leaves[-1]],
+            "clade": clade,
+            "support": clades[clade][1],
+            "parent_duplication": parent,
+            "parent_support": clades[parent][1] if parent != None else None,
+            "species": clade_species[clade].bit_count(),
+            "duplication": duplications[clade]
+        }
+        row.update(score_candidate(set(members), curated))
+        if row["jaccard"] > best_jaccard:
+            best_members, best_jaccard = members, row["jaccard"]
+        rows.append(row)
+    print(f"{protein}: {sum(duplications)} duplications, {len(rows)} candidate orthogroups, best Jaccard index {best_jaccard:.3f}")
+    return protein, rows, best_members
+
+
+def _infer_orthogroups(task):
+    return infer_orthogroups(*task)
+
+
+def get_tasks(base_directory):
+    """Collect the gene trees and the most recent orthogroup list of each protein directory"""
+    tasks = []
+    for protein in sorted(os.listdir(base_directory)):
+        protein_dir = os.path.join(base_directory, protein)
+        if not os.path.isdir(protein_dir):
+            continue
+        files = os.listdir(protein_dir)
+        trees = sorted(f for f in files if f.startswith("euk5_homs") and f.endswith(tree_suffixes))
+        orth_files = sorted((f for f in files if 'euk5_orths' in f and f.endswith('.txt')), reverse=True)
+        if len(trees) == 0:
+            print(f"{protein_dir} contains no gene tree")
+            continue
+        if len(orth_files) == 0:
+            print(f"{protein_dir} contains no orths text file")
+            continue
+        for tree in trees:
+            # File name convention: prefix - protname - suffix; use the protein name of the tree if there are several
+            tree_protein = tree.split(".")[1] if len(trees) > 1 else protein
+            tasks.append((tree_protein, os.path.join(protein_dir, tree), os.path.join(protein_dir, orth_files[0])))
+    return tasks
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Propose orthogroups from gene trees by species overlap and score them against the orthogroup lists")
+    parser.add_argument("-d", metavar="base_directory", type=str, default="../proteins/", help="directory containing all protein folders")
+    parser.add_argument("-s", metavar="overlap_score", type=float, default=0.0, help="species-overlap score above which a node is a duplication")
+    parser.add_argument("-o", metavar="output_dir", type=str, help="output directory - current working directory if not specified")
+    parser.add_argument("-n", metavar="threads", type=int, default=1, help="number of processes (trees processed in parallel)")
+    args = parser.parse_args()
+
+    outdir = os.path.join(args.o if args.o != None else os.getcwd(), "")
+    os.makedirs(outdir, exist_ok=True)
+
+    tasks = [task + (args.s,) for task in get_tasks(args.d)]
+    if len(tasks) == 0:
+        print(f"Error: no protein directory in {args.d} contains both a gene tree and an orths text file")
+    if args.n > 1:
+        with multiprocessing.Pool(args.n) as pool:
+            results = pool.map(_infer_orthogroups, tasks)
+    else:
+        results = [_infer_orthogroups(task) for task in tasks]
+
+    all_rows = []
+    for protein, rows, best_members in results:
+        all_rows += rows
+        with open(f"{outdir}euk5_candorths.{protein}.txt", "w") as outfile:
+            for member in best_members:
+                outfile.write(f"{member}\n")
+
+    candidates = pd.DataFrame(all_rows, columns=candidate_columns)
+    # clades without a parent duplication (the whole tree) have no parent index; keep the indices integers
+    candidates["parent_duplication"] = candidates["parent_duplication"].astype("Int64")
+    candidates = candidates.sort_values(["protein", "jaccard"], ascending=[True, False])
+    candidates.to_csv(f"{outdir}euk5_candorths.species_overlap_{args.s}.csv", index=False)
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+
+"""
+map_conservation_to_structures.py
+
+This script maps the per-residue conservation of the Nse5 and Nse6 orthogroup alignments onto the AlphaFold2
+models of the Nse5 and Nse6 alpha-solenoid domains (protein_families/Nse56/Nse5_Nse6_solenoids_AF2), so that
+conserved regions can be inspected on the structures, e.g. in PyMOL ('spectrum b').
+
+Per alignment column, two conservation scores are computed for all columns at once (NumPy):
+1. Shannon entropy, reported as conservation: 1 - entropy / log2(20)
+2. Jensen-Shannon divergence from the BLOSUM62 background amino acid distribution (Capra & Singh, 2007)
+Both scores are multiplied by the fraction of non-gap residues in the column, to penalize gappy columns. Ambiguous
+and non-standard residues (e.g. X, B, Z, U) are not gaps, but are left out of the amino acid frequencies.
+
+The species and protein of each model are taken from its file name, e.g. KLENIT009521_Nse5_rank23_... is the
+Nse5 protein KLENIT009521. The alignment columns are mapped to the residue numbers of the model through the
+aligned sequence of the protein: its ungapped sequence is matched to the sequence of the model, so that models
+of a part of the protein (or numbered differently) are mapped correctly. Each alignment is read once; the
+models are written in parallel, with the conservation score (x 100) in the B-factor column. Residues that are
+not in the alignment, or that are not aligned to a column, get a B-factor of 0.
+
+Required input:
+- Alignments (FASTA) of the proteins; the protein name is taken from the file name following the filename
+  convention (e.g. euk5_homs9.Nse5.linsi.cut.fa)
+- Directory containing the models (PDB)
+
+Output:
+- Table (csv) with the conservation scores of each alignment column, for each alignment
+- Models (PDB) with the conservation score in the B-factor column
+
+Example usage: map_conservation_to_structures.py -a ../proteins/Nse5/euk5_homs9.Nse5.linsi.cut.fa ../proteins/Nse6/euk5_homs4.Nse6.linsi.cut.fa -o conservation_structures/
+"""
+
+
+import argparse
+import difflib
+import multiprocessing
+import os
+import numpy as np
+import pandas as pd
+
+
+amino_acids = "ACDEFGHIKLMNPQRSTVWY"
+gap_characters = "-."
+
+# indices of the symbols following the amino acids: gaps and other (ambiguous or non-standard) residues
+gap_index = len(amino_acids)
+other_index = len(amino_acids) + 1
+
+# BLOSUM62 background distribution, in the order of amino_acids
+blosum62_background = np.array([0.074, 0.025, 0.054, 0.054, 0.047, 0.074, 0.026, 0.068, 0.058, 0.099,
+                                0.025, 0.045, 0.039, 0.034, 0.052, 0.057, 0.051, 0.073, 0.013, 0.032])
+blosum62_background = blosum62_background / blosum62_background.sum()
+
+three_to_one = {
+    "ALA": "A", "CYS": "C", "ASP": "D", "GLU": "E", "PHE": "F", "GLY": "G", "HIS": "H", "ILE": "I", "LYS": "K", "LEU": "L",
+    "MET": "M", "ASN": "N", "PRO": "P", "GLN": "Q", "ARG": "R", "SER": "S", "THR": "T", "VAL": "V", "TRP": "W", "TYR": "Y"
+}
+
+
+def read_alignment(path):
+    """Read an aligned FASTA file into a list of (identifier, aligned sequence) tuples"""
+    records = []
+    with open(path, "r") as infile:
+        for line in infile:
+            line = line.strip()
+            if line.startswith(">"):
+                records.append([line[1:].split()[0], []])
+            elif line:
+                records[-1][1].append(line)
+    return [(name, "".join(parts).upper()) for name, parts in records]
+
+
+def encode_alignment(sequences):
+    """Encode the aligned sequences as a matrix (sequences x columns) of amino acid indices; gaps are 20 and other residues 21"""
+    lookup = np.full(256, other_index, dtype=np.uint8)
+    for i, aa in enumerate(amino_acids):
+        lookup[ord(aa)] = i
+    for gap in gap_characters:
+        lookup[ord(gap)] = gap_index
+    matrix = np.frombuffer("".join(sequences).encode("ascii"), dtype=np.uint8).reshape(len(sequences), -1)
+    return lookup[matrix]
+
+
+def column_conservation(codes, pseudocount=1e-6):
+    """Compute the entropy-based and the Jensen-Shannon conservation of all alignment columns"""
+    n_sequences, n_columns = codes.shape
+    n_symbols = len(amino_acids) + 2
+    # Count all symbols of all columns at once: offset the indices of each column by the number of symbols
+    offsets = np.arange(n_columns) * n_symbols
+    counts = np.bincount((codes + offsets).ravel(), minlength=n_columns * n_symbols).reshape(n_columns, n_symbols)
+    aa_counts = counts[:, :gap_index] + pseudocount
+    frequencies = aa_counts / aa_counts.sum(axis=1, keepdims=True)
+    non_gap_fraction = 1 - counts[:, gap_index] / n_sequences
+
+    entropy = -(frequencies * np.log2(frequencies)).sum(axis=1)
+    entropy_conservation = (1 - entropy / np.log2(len(amino_acids))) * non_gap_fraction
+
+    mixture = 0.5 * (frequencies + blosum62_background)
+    js_divergence = 0.5 * (frequencies * np.log2(frequencies / mixture)).sum(axis=1) + \
+        0.5 * (blosum62_background * np.log2(blosum62_background / mixture)).sum(axis=1)
+    js_conservation = js_divergence * non_gap_fraction
+
+    return pd.DataFrame({
+        "column": np.arange(1, n_columns + 1),
+        "non_gap_fraction": non_gap_fraction,
+        "entropy": entropy_conservation,
+        "js": js_conservation
+    })
+
+
+def read_structure_residues(pdb_lines):
+    """Get the residue numbers and amino acids (one-letter code) of the C-alpha atoms of a model"""
+    residues = []
+    for line in pdb_lines:
+        if line.startswith("ATOM") and line[12:16].strip() == "CA":
+            residues.append((int(line[22:26]), three_to_one.get(line[17:20], "X")))
+    return residues
+
+
+def map_columns_to_residues(aligned_sequence, residues):
+    """Map alignment columns to the residue numbers of a model by matching the ungapped aligned sequence to the model sequence"""
+    # Alignment column (0-based) of each residue of the ungapped aligned sequence
+    residue_columns = [i for i, aa in enumerate(aligned_sequence) if aa not in gap_characters]
+    ungapped = "".join(aa for aa in aligned_sequence if aa not in gap_characters)
+    structure_sequence = "".join(aa for number, aa in residues)
+    matcher = difflib.SequenceMatcher(None, ungapped, structure_sequence, autojunk=False)
+    column_to_residue = {}
+    for block in matcher.get_matching_blocks():
+        for k in range(block.size):
+            column_to_residue[residue_columns[block.a + k]] = residues[block.b + k][0]
+    return column_to_residue
+
+
+def set_bfactors(pdb_lines, residue_scores):
+    """Replace the B-factors of all atoms by the score of their residue (0 for residues without score)"""
+    new_lines = []
+    for line in pdb_lines:
+        if line.startswith(("ATOM", "HETATM")) and len(line) >= 66:
+            score = residue_scores.get(int(line[22:26]), 0.0)
+            line = f"{line[:60]}{score:6.2f}{line[66:]}"
+        new_lines.append(line)
+    return new_lines
+
+
+def get_model_protein(model_path):
+    """Get the sequence identifier and protein from the file name of a model, e.g. KLENIT009521_Nse5_rank23_..."""
+    identifier, protein = os.path.basename(model_path).split("_")[:2]
+    return identifier, protein
+
+
+# Aligned sequences and conservation scores are shared with the worker processes through the initializer
+_alignments = {}
+
+
+def _init_worker(alignments):
+    global _alignments
+    _alignments = alignments
+
+
+def write_model_conservation(model_path, outdir, score):
+    identifier, protein = get_model_protein(model_path)
+    if protein not in _alignments:
+        print(f"Error: no alignment provided for {protein} ({os.path.basename(model_path)})")
+        return None
+    aligned_sequences, conservation = _alignments[protein]
+    if identifier not in aligned_sequences:
+        print(f"Error: {identifier} not found in the {protein} alignment")
+        return None
+    with open(model_path, "r") as infile:
+        pdb_lines = infile.readlines()
+    residues = read_structure_residues(pdb_lines)
+    column_to_residue = map_columns_to_residues(aligned_sequences[identifier], residues)
+    scores = conservation[score]
+    residue_scores = {residue: 100 * scores[column] for column, residue in column_to_residue.items()}
+    outfile_path = f"{outdir}{os.path.basename(model_path)[:-len('.pdb')]}.conservation_{score}.pdb"
+    with open(outfile_path, "w") as outfile:
+        outfile.writelines(set_bfactors(pdb_lines, residue_scores))
+    return identifier, protein, len(residues), len(column_to_residue)
+
+
+def _write_model_conservation(task):
+    return write_model_conservation(*task)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Map alignment conservation onto AlphaFold2 models (B-factor column)")
+    parser.add_argument("-a", metavar="alignments", nargs="+", type=str, required=True, help="aligned FASTA files; the protein name is the second field of the filename, e.g. euk5_homs9.Nse5.linsi.cut.fa")
+    parser.add_argument("-s", metavar="structure_dir", type=str, default="../protein_families/Nse56/Nse5_Nse6_solenoids_AF2/", help="directory containing the models (PDB)")
+    parser.add_argument("-c", metavar="score", type=str, choices=["js", "entropy"], default="js", help="conservation score written to the B-factor column: 'js' (Jensen-Shannon divergence) or 'entropy'")
+    parser.add_argument("-o", metavar="output_dir", type=str, help="output directory - current working directory if not specified")
+    parser.add_argument("-n", metavar="threads", type=int, default=1, help="number of processes used for writing the models")
+    args = parser.parse_args()
+
+    outdir = os.path.join(args.o if args.o != None else os.getcwd(), "")
+    os.makedirs(outdir, exist_ok=True)
+
+    # Read each alignment once and compute the conservation of all its columns
+    alignments = {}
+    for alignment_path in args.a:
+        protein = os.path.basename(alignment_path).split(".")[1]
+        records = read_alignment(alignment_path)
+        conservation = column_conservation(encode_alignment([seq for name, seq in records]))
+        conservation.to_csv(f"{outdir}{os.path.basename(alignment_path)}.conservation.csv", index=False)
+        # Identifiers without the sequence range, e.g. KLENIT009521/203-522
+        aligned_sequences = {name.split("/")[0]: seq for name, seq in records}
+        alignments[protein] = (aligned_sequences, {score: conservation[score].to_numpy() for score in ["js", "entropy"]})
+
+    model_paths = [os.path.join(args.s, f) for f in sorted(os.listdir(args.s)) if f.endswith(".pdb")]
+    tasks = [(path, outdir, args.c) for path in model_paths]
+    if args.n > 1:
+        with multiprocessing.Pool(args.n, initializer=_init_worker, initargs=(alignments,)) as pool:
+            results = pool.map(_write_model_conservation, tasks)
+    else:
+        _init_worker(alignments)
+        results = [_write_model_conservation(task) for task in tasks]
+
+    for result in results:
+        if result != None:
+            identifier, protein, n_residues, n_mapped = result
+            print(f"{identifier} ({protein}): {n_mapped} of {n_residues} residues mapped to alignment columns")